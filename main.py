@@ -5,8 +5,12 @@ This file allows you to split csv data into multiple different csv called Team.c
 based algorithm that matches together different universities together. You are prompted to either enter a csv path, test with the
 preset file or quit the CLI tool. It will also conduct a series of statistical analysis and spit them out into several csv.
 """
+import numpy as np
 import pandas as pd
-from fuzzywuzzy import process, fuzz
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from rapidfuzz import process, fuzz, utils
 
 # Define a dictionary to convert US state abbreviations to full names
 state_abbreviations = {
@@ -32,48 +36,110 @@ state_abbreviations = {
 
 
 def fuzzy_grouping(dataframe, column_name, threshold=89):
-    # Extract unique institution names
-    names = dataframe[column_name].unique()
+    # Extract unique institution names, missing names are left out and stay missing after the grouping
+    names = dataframe[column_name].dropna().unique()
+
+    # Normalize and token sort every name once up front, the scorer then only has to compare the results
+    processed = np.array([' '.join(sorted(utils.default_process(name).split())) for name in names], dtype=object)
+    lengths = np.array([len(name) for name in processed])
+
+    # Names that are identical once normalized are matched with a dictionary lookup, only the first name with
+    # each normalized form goes through the fuzzy scorer
+    exact = {}
+    exact_matches = np.array([exact.setdefault(name, i) for i, name in enumerate(processed)], dtype=np.intp)
+    is_first = exact_matches == np.arange(len(names))
+
+    # Best scoring earlier name for each name, a score of 0 means nothing came close enough
+    best_matches = np.zeros(len(names), dtype=np.intp)
+    best_scores = np.zeros(len(names), dtype=np.uint8)
+
+    # Scores are rounded to whole numbers, so only a score from threshold + 0.5 upwards can end up above the
+    # threshold. Using that as the cutoff lets the scorer give up on every other pair early and store it as 0
+    score_cutoff = threshold + 0.5
+
+    # A ratio can never be higher than 1 - |a - b| / (a + b) for strings of length a and b, so names are only
+    # compared against names whose length is close enough to still reach the cutoff. The ratio is symmetric,
+    # so each bucket is only scored against names of the same length or longer and the scores are used both ways
+    ratio = score_cutoff / 100
+    for length in np.unique(lengths[is_first]):
+        rows = np.flatnonzero(is_first & (lengths == length))
+        cols = np.flatnonzero(is_first & (lengths >= length) & (lengths <= np.ceil(length * (2 - ratio) / ratio)))
+
+        # Score the bucket against its candidates in one call on all cores, pairs under the cutoff are stored
+        # as 0. A plain ratio on token sorted strings is the same as token_sort_ratio on the original names
+        scores = process.cdist(processed[rows], processed[cols], scorer=fuzz.ratio, processor=None,
+                               score_cutoff=score_cutoff, dtype=np.float64, workers=-1)
+
+        # Round half to even like round() does, scores that don't end up above the threshold are stored as 0
+        scores = np.rint(scores).astype(np.uint8)
+        scores[scores <= threshold] = 0
+
+        for query, candidates, block in ((rows, cols, scores), (cols, rows, scores.T)):
+            # A name can only be grouped under a name that came before it
+            block = np.where(candidates < query[:, None], block, 0)
+            best = block.argmax(axis=1)
+            score = block[np.arange(len(query)), best]
+            match = candidates[best]
+
+            # Keep the highest score seen so far, on a tie the earliest name wins
+            better = (score > 0) & ((score > best_scores[query]) |
+                                    ((score == best_scores[query]) & (match < best_matches[query])))
+            best_scores[query[better]] = score[better]
+            best_matches[query[better]] = match[better]
+
+    # Index of the name each name is grouped under, every name starts out grouped under itself
+    grouped_index = np.arange(len(names))
+    for i in range(len(names)):
+        if not is_first[i]:
+            # An exact match is grouped under the first name that had the same normalized form
+            grouped_index[i] = grouped_index[exact_matches[i]]
+        elif best_scores[i]:
+            # If a close match is found above threshold, group it under the matched name
+            grouped_index[i] = grouped_index[best_matches[i]]
+
     # Dictionary to hold the mapping from original to grouped name
-    grouped_names = {}
-
-    # Iterate through each name
-    for name in names:
-        if grouped_names:
-            # Check for fuzzy match in already grouped names
-            match, score = process.extractOne(name, list(grouped_names.keys()), scorer=fuzz.token_sort_ratio)
-            if score > threshold:
-                # If a close match is found above threshold, group it under the matched name
-                grouped_names[name] = grouped_names[match]
-            else:
-                # Otherwise, group it under itself
-                grouped_names[name] = name
-        else:
-            # Initialize with the first name if empty
-            grouped_names[name] = name
+    grouped_names = dict(zip(names, names[grouped_index]))
 
-    # Apply the grouping to the original dataframe column
-    dataframe['Grouped Institution'] = dataframe[column_name].map(grouped_names)
+    # Apply the grouping to the original dataframe column, keeping its dtype so missing names don't turn it into
+    # a generic object column
+    dataframe['Grouped Institution'] = dataframe[column_name].map(grouped_names).astype(dataframe[column_name].dtype)
     return dataframe
 
 
+"""
+Writes a data frame to a csv file with the pyarrow C++ writer, the index is left out like to_csv(index=False).
+"""
+
+
+def write_csv(dataframe, path):
+    pacsv.write_csv(pa.Table.from_pandas(dataframe, preserve_index=False), path)
+
+
 """
 Data wrangling function, used to clean and group the fields for csv and statistical analysis.
 """
 
 
 def save_csv(file_path):
+    required_columns = {'Institution', 'City', 'State/Province', 'Country', 'Team Number', 'Advisor', 'Problem',
+                        'Ranking'}
+    # Read the text columns as strings, a column without any values would otherwise be typed as null
+    text_columns = {column: pd.ArrowDtype(pa.string()) for column in required_columns - {'Team Number'}}
+
     # Try to load the data from the CSV file
     try:
-        # Load the data from the CSV file
-        data_2015 = pd.read_csv(file_path)
+        try:
+            # Load only the required columns with the multithreaded pyarrow reader
+            data_2015 = pd.read_csv(file_path, usecols=sorted(required_columns), dtype=text_columns, engine='pyarrow',
+                                    dtype_backend='pyarrow')
+        except (KeyError, ValueError):
+            # Load every column so any missing required columns can be reported below
+            data_2015 = pd.read_csv(file_path, dtype=text_columns, dtype_backend='pyarrow')
     except Exception as e:
         print(f"Failed to load data: {e}")
         return
 
     # Check for the required headers in the CSV
-    required_columns = {'Institution', 'City', 'State/Province', 'Country', 'Team Number', 'Advisor', 'Problem',
-                        'Ranking'}
     if not required_columns.issubset(data_2015.columns):
         missing_columns = required_columns - set(data_2015.columns)
         print(f"Missing required columns: {missing_columns}")
@@ -86,38 +152,50 @@ def save_csv(file_path):
     data_2015.loc[:, 'State/Province'] = data_2015['State/Province'].fillna('Unknown')
 
     for column in data_2015.columns:
-        if data_2015[column].dtype == object and column != 'Country':
+        if pd.api.types.is_string_dtype(data_2015[column]) and column != 'Country':
             if column == 'State/Province':
                 # Convert 2-letter abbreviations to full names
-                data_2015[column] = data_2015[column].str.strip().apply(
-                    lambda x: state_abbreviations[x.upper()] if x.upper() in state_abbreviations and len(x) == 2 else x)
+                states = data_2015[column].str.strip()
+                is_abbreviation = states.str.fullmatch('[A-Za-z]{2}').to_numpy(dtype=bool)
+                expanded = states.str.upper().map(state_abbreviations)
+                data_2015[column] = pd.Series(np.where(is_abbreviation & expanded.notna(), expanded, states),
+                                              index=data_2015.index, dtype=states.dtype)
             elif column != 'Advisor':  # Skip capitalization for 'Advisor'
-                # Capitalize other columns
-                data_2015[column] = data_2015[column].str.strip().str.capitalize()
+                # Capitalize other columns, stripping and capitalizing in one pass with the pyarrow string kernels
+                capitalized = pc.utf8_capitalize(pc.utf8_trim_whitespace(pa.array(data_2015[column])))
+                data_2015[column] = pd.Series(capitalized, index=data_2015.index, dtype=data_2015[column].dtype)
 
-    # Creating a unique list of institutions
-    institutions = data_2015[['Grouped Institution', 'City', 'State/Province', 'Country']].drop_duplicates(
-        subset=['Grouped Institution'])
+    # Store the repeated location and institution columns as categories, de-duplicating and looking up institutions
+    # below then works on the integer codes instead of comparing strings
+    for column in ['Grouped Institution', 'State/Province', 'Country']:
+        data_2015[column] = data_2015[column].astype('category')
 
-    institutions.reset_index(drop=True, inplace=True)
-    institutions.index.name = 'Institution ID'
-    institutions.reset_index(inplace=True)
+    # Creating a unique list of institutions
+    first_rows = ~data_2015['Grouped Institution'].duplicated()
+    institutions = data_2015.loc[first_rows, ['Grouped Institution', 'City', 'State/Province', 'Country']].reset_index(
+        drop=True)
+    institutions.insert(0, 'Institution ID', np.arange(len(institutions), dtype=np.int32))
     institutions.columns = ['Institution ID', 'Institution Name', 'City', 'State/Province', 'Country']
 
     # Save the Institutions CSV file
     institutions_path = 'results/Institutions.csv'
-    institutions.to_csv(institutions_path, index=False)
+    write_csv(institutions, institutions_path)
 
-    # Merging team data with grouped institutions to get the correct Institution ID
+    # Mapping team data to grouped institutions to get the correct Institution ID
     team_details_correct = data_2015[['Team Number', 'Advisor', 'Problem', 'Ranking', 'Grouped Institution']].copy()
-    team_details_correct = team_details_correct.merge(institutions[['Institution Name', 'Institution ID']],
-                                                      left_on='Grouped Institution', right_on='Institution Name',
-                                                      how='left')
-    team_details_correct.drop('Institution Name', axis=1, inplace=True)
+    # Rankings only take a handful of values, as a category the ranking filters compare small integer codes
+    team_details_correct['Ranking'] = team_details_correct['Ranking'].astype('category')
+    name_to_id = dict(zip(institutions['Institution Name'], institutions['Institution ID']))
+    institution_ids = team_details_correct['Grouped Institution'].map(name_to_id)
+    missing_name = institutions['Institution Name'].isna()
+    if missing_name.any():
+        # Teams without an institution name share the institution row kept for missing names
+        institution_ids = institution_ids.astype(float).fillna(institutions.loc[missing_name, 'Institution ID'].iloc[0])
+    team_details_correct['Institution ID'] = institution_ids.astype(int)
 
     # Save the Teams CSV file
     teams_path = 'results/Teams.csv'
-    team_details_correct.to_csv(teams_path, index=False)
+    write_csv(team_details_correct, teams_path)
 
     print("SQL ready files saved:", institutions_path, teams_path)
 
@@ -126,25 +204,36 @@ def save_csv(file_path):
 
 
 def get_statistical_analysis_file(teams_df, institutions_df):
-    # Convert 'Institution ID' to integer
-    teams_df['Institution ID'] = teams_df['Institution ID'].astype(int)
+    # Convert 'Institution ID' and 'Team Number' to the smallest integer type that fits, keeping the hash tables
+    # of the groupby and merges below small
+    teams_df['Institution ID'] = pd.to_numeric(teams_df['Institution ID'], downcast='integer')
+    teams_df['Team Number'] = pd.to_numeric(teams_df['Team Number'], downcast='integer')
+
+    # Problems are a handful of letters, store them as a category. Going through a string type first keeps a
+    # column without any values from being typed as null, which can't be made into categories
+    teams_df['Problem'] = teams_df['Problem'].astype(pd.ArrowDtype(pa.string())).astype('category')
+
+    # Count the unique and total teams per institution in a single groupby pass
+    teams_per_institution = teams_df.groupby('Institution ID', sort=False)['Team Number'].agg(
+        unique_teams='nunique', total_rows='size').reset_index()
 
     # Calculate the average number of teams per institution
-    avg_teams_per_institution = int(teams_df.groupby('Institution ID')['Team Number'].nunique().mean())
+    avg_teams_per_institution = int(teams_per_institution['unique_teams'].mean())
     print("Average Teams per Institution: ", avg_teams_per_institution)
 
     # Count the number of teams per institution
-    institutions_teams_count = teams_df['Institution ID'].value_counts().reset_index()
-    institutions_teams_count.columns = ['Institution ID', 'Number of Teams']
+    institutions_teams_count = teams_per_institution[['Institution ID', 'total_rows']].rename(
+        columns={'total_rows': 'Number of Teams'})
 
     # Merge with institutions_df to get institution details
     top_institutions = institutions_teams_count.merge(institutions_df, on='Institution ID').sort_values(
-        by='Number of Teams', ascending=False)
+        by='Number of Teams', ascending=False, kind='stable')
 
     # Filter institutions that received 'Outstanding' rankings
-    outstanding_institutions = teams_df[teams_df['Ranking'] == 'Outstanding winner']['Institution ID'].unique()
-    outstanding_institutions_list = institutions_df[
-        institutions_df['Institution ID'].isin(outstanding_institutions)].sort_values(by='Institution Name')
+    outstanding = teams_df['Ranking'].eq('Outstanding winner')
+    outstanding_institutions = teams_df.loc[outstanding, 'Institution ID'].drop_duplicates()
+    outstanding_institutions_list = institutions_df.set_index('Institution ID').loc[
+        outstanding_institutions].sort_values(by='Institution Name').reset_index()
 
     # Merge with institutions_df to get country information
     team_df_with_country = teams_df.merge(institutions_df[['Institution ID', 'Country']], on='Institution ID',
@@ -156,15 +245,15 @@ def get_statistical_analysis_file(teams_df, institutions_df):
 
     # Output paths
     outstanding_institutions_list_path = 'results/Outstanding_Institutions.csv'
-    outstanding_institutions_list.to_csv(outstanding_institutions_list_path, index=False)
+    write_csv(outstanding_institutions_list, outstanding_institutions_list_path)
     print("Path to Outstanding Institutions:", outstanding_institutions_list_path)
 
     top_institutions_path = 'results/Top_Institutions.csv'
-    top_institutions.to_csv(top_institutions_path, index=False)
+    write_csv(top_institutions, top_institutions_path)
     print("Path to Top Institutions:", top_institutions_path)
 
     us_teams_meritorious_or_better_path = 'results/US_Teams_Meritorious_or_Better.csv'
-    us_teams_meritorious_or_better.to_csv(us_teams_meritorious_or_better_path, index=False)
+    write_csv(us_teams_meritorious_or_better, us_teams_meritorious_or_better_path)
     print("Path to US Teams with Meritorious or Better Ranking:", us_teams_meritorious_or_better_path)
 
 